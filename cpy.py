@@ -1,25 +1,117 @@
 #!/usr/bin/env python3
 
+import contextlib
+import ctypes
+import errno
 import filecmp
 import fnmatch
+import itertools
+import mmap
 import os
+import pickle
+import queue
+import re
 import shutil
+import stat
 import subprocess
+import sys
+import tempfile
+import threading
 import time
 import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from Foundation import NSFileManager
+from Foundation import NSFileManager, NSMutableDictionary
 from diskcache import Cache
-from osxmetadata import OSXMetaData
+import xattr
 
 SPACE = ' ' * 10  # Used in place of printing two tabs
 PROG_FILE_NAME = '.cp_progress'
+PROG_BATCH_SIZE = 256  # Number of prog_cache changes to commit per transaction
+MAX_IN_FLIGHT = 1024  # Max number of copies queued up for cp_ls's workers at once
+CMP_CHUNK_SIZE = 8 * 1024 * 1024  # Bytes compared at a time by fast_cmp
+PROGRESS_INTERVAL = 0.05  # Min seconds between progress line redraws
 manager = NSFileManager.defaultManager()
+DESIRED_ATTRS = ('NSFileExtensionHidden', 'NSFileCreationDate', 'NSFileModificationDate')  # Cloned by clone_attrs
+# Xattrs restored by check_meta: these, plus any starting with META_XATTR_PREFIX (tags, Finder comment, where froms...)
+META_XATTRS = ('com.apple.FinderInfo', 'com.apple.ResourceFork')
+META_XATTR_PREFIX = 'com.apple.metadata:'
+_thread_local = threading.local()  # Per-thread scratch objects, since copies run on worker threads
+
+# Flags from <copyfile.h> and <sys/clonefile.h>
+COPYFILE_ALL = 0x000F  # ACL | STAT | XATTR | DATA, i.e. everything cp -p would preserve
+COPYFILE_EXCL = 1 << 17
+COPYFILE_NOFOLLOW_SRC = 1 << 18
+COPYFILE_CLONE = 1 << 24
+CLONE_NOFOLLOW = 0x0001
+
+libc = ctypes.CDLL('/usr/lib/libSystem.B.dylib', use_errno=True)
+libc.copyfile.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_uint32]
+libc.copyfile.restype = ctypes.c_int
+# clonefile(2) only exists on Sierra and newer
+clonefile = getattr(libc, 'clonefile', None)
+if clonefile is not None:
+    clonefile.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint32]
+    clonefile.restype = ctypes.c_int
+# Whether cp tries clonefile(2) before copyfile(3). Turned off the first time clonefile says src and dst can't share
+# blocks (e.g. dst is another volume), so a run to a non-APFS dst doesn't pay a failed syscall for every file.
+# Nothing is lost by that, since copyfile's COPYFILE_CLONE still clones whatever it can.
+clone_first = clonefile is not None
 
 
 def cp(src, dst):
-    """Copies src to dst. Uses flags -Rpn to preserve resource forks."""
-    res = subprocess.run(['/bin/cp', '-Rpn', src, f'{os.path.dirname(dst)}'], check=True, capture_output=True)
+    """
+    Copies src to dst without spawning a process. Tries clonefile(2) first, which is a copy-on-write clone on APFS,
+    then falls back to copyfile(3). Both preserve resource forks, xattrs and flags, and copy symlinks as symlinks.
+    Raises OSError on failure, including if dst already exists.
+    """
+    global clone_first
+    b_src, b_dst = os.fsencode(src), os.fsencode(dst)
+
+    if clone_first:
+        if clonefile(b_src, b_dst, CLONE_NOFOLLOW) == 0:
+            return
+        err = ctypes.get_errno()
+        # EXDEV and ENOTSUP mean src and dst can't share blocks, so do a real copy instead
+        if err not in (errno.EXDEV, errno.ENOTSUP):
+            raise OSError(err, os.strerror(err), src, None, dst)
+        clone_first = False
+
+    flags = COPYFILE_ALL | COPYFILE_EXCL | COPYFILE_NOFOLLOW_SRC
+    if clonefile is not None:
+        flags |= COPYFILE_CLONE
+    if libc.copyfile(b_src, b_dst, None, flags) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), src, None, dst)
+
+
+class InMemoryCache(dict):
+    """
+    Stands in for a diskcache Cache when the failed file database doesn't need to outlive the run.
+    Implements just the parts of Cache's interface that prog_cache is used through, with no SQLite underneath.
+    """
+
+    def set(self, key, value):
+        self[key] = value
+
+    def delete(self, key):
+        self.pop(key, None)
+
+    def iterkeys(self):
+        return iter(list(self))
+
+    @contextlib.contextmanager
+    def transact(self, retry=False):
+        yield
+
+
+def bin_cp(src, dst):
+    """Copies src to dst with /bin/cp. Uses flags -Rpn to preserve resource forks."""
+    # Python's fds are non-inheritable anyway, and leaving close_fds off lets subprocess start cp with posix_spawn
+    # (Python 3.8+) instead of forking this whole process for every file
+    res = subprocess.run(['/bin/cp', '-Rpn', src, f'{os.path.dirname(dst)}'], check=True, capture_output=True,
+                         close_fds=False)
     return res
 
 
@@ -31,9 +123,23 @@ def clone_attrs(src, dst, follow_symlinks=True, limit=10):
     """
 
     def get_desired_attrs(attrs):
-        """Gets the important attrs from an NSDictionary of file attrs"""
-        desired_attrs = ['NSFileExtensionHidden', 'NSFileCreationDate', 'NSFileModificationDate']
-        return {k: v for k, v in dict(attrs).items() if k in desired_attrs}
+        """
+        Gets the important attrs from an NSDictionary of file attrs, in DESIRED_ATTRS order.
+        Only those keys are looked up, rather than bridging the whole dict over to Python.
+        """
+        return [attrs.objectForKey_(k) for k in DESIRED_ATTRS]
+
+    def to_attrs_dict(values):
+        """Fills this thread's reusable NSMutableDictionary with values from get_desired_attrs."""
+        attrs_dict = getattr(_thread_local, 'attrs_dict', None)
+        if attrs_dict is None:
+            attrs_dict = _thread_local.attrs_dict = NSMutableDictionary.alloc().initWithCapacity_(len(DESIRED_ATTRS))
+        for k, v in zip(DESIRED_ATTRS, values):
+            if v is None:
+                attrs_dict.removeObjectForKey_(k)
+            else:
+                attrs_dict.setObject_forKey_(v, k)
+        return attrs_dict
 
     def clone():
         if follow_symlinks:
@@ -45,7 +151,7 @@ def clone_attrs(src, dst, follow_symlinks=True, limit=10):
             if d_src_attrs == d_dst_attrs:
                 return True
 
-            success, err = manager.setAttributes_ofItemAtPath_error_(d_src_attrs, dst, None)
+            success, err = manager.setAttributes_ofItemAtPath_error_(to_attrs_dict(d_src_attrs), dst, None)
             if not success:
                 raise Exception(f'Error cloning attrs from {src} to {dst}')
 
@@ -57,6 +163,16 @@ def clone_attrs(src, dst, follow_symlinks=True, limit=10):
             shutil.copystat(src, dst, follow_symlinks=False)
         return True
 
+    # Most of the time the dates already match after a copy, and a stat is far cheaper than going through Foundation
+    stat_func = os.stat if follow_symlinks else os.lstat
+    try:
+        src_st, dst_st = stat_func(src), stat_func(dst)
+        if src_st.st_mtime_ns == dst_st.st_mtime_ns and \
+                getattr(src_st, 'st_birthtime', None) == getattr(dst_st, 'st_birthtime', None):
+            return
+    except OSError:
+        pass
+
     for i in range(limit):
         if clone():
             return
@@ -71,6 +187,28 @@ def paths_are(os_path_func, *args, cmp_func=all):
     return cmp_func([os_path_func(path) for path in args])
 
 
+def fast_cmp(a, b, shallow=False):
+    """
+    Compares the contents of files a and b, the same way filecmp.cmp does. Rather than filecmp's 8 KiB reads and
+    Python-level compares, both files are mmapped and compared CMP_CHUNK_SIZE at a time, so the compare runs in C.
+    """
+    a_st, b_st = os.stat(a), os.stat(b)
+    if a_st.st_size != b_st.st_size:
+        return False
+    if shallow and a_st.st_mtime == b_st.st_mtime:
+        return True
+    if not a_st.st_size:
+        return True  # mmap can't map empty files, and two empty files are equal anyway
+
+    with open(a, 'rb') as fa, open(b, 'rb') as fb, \
+            mmap.mmap(fa.fileno(), 0, access=mmap.ACCESS_READ) as ma, \
+            mmap.mmap(fb.fileno(), 0, access=mmap.ACCESS_READ) as mb:
+        for offset in range(0, len(ma), CMP_CHUNK_SIZE):
+            if ma[offset:offset + CMP_CHUNK_SIZE] != mb[offset:offset + CMP_CHUNK_SIZE]:
+                return False
+    return True
+
+
 def cmp(src, dst, shallow):
     """Compares symlinks to symlinks and files to files. If given a symlink and a file, treats link as a file."""
 
@@ -81,7 +219,7 @@ def cmp(src, dst, shallow):
     if paths_are(os.path.islink, src, dst):
         return cmp_links(src, dst)
     elif paths_are(os.path.isfile, src, dst):
-        return filecmp.cmp(src, dst, shallow=shallow)
+        return fast_cmp(src, dst, shallow=shallow)
     elif paths_are(os.path.isdir, src, dst):
         dcmp = filecmp.dircmp(src, dst)
         return not bool(dcmp.left_only or dcmp.right_only or dcmp.diff_files)
@@ -89,184 +227,443 @@ def cmp(src, dst, shallow):
     return False
 
 
-def cp_ls(src_ls, dst_ls):
+def _copy_one(src, dst, prev_err):
+    """
+    Copies a single src to dst, cloning its attrs along the way. Safe to call from worker threads.
+    Prev_err is src's record in prog_cache, or None if it doesn't have one.
+    Returns (src, exception, prog_op). Exception is None if the copy succeeded (or was skipped).
+    Prog_op is the change cp_ls should make to prog_cache, as (src, record), where a record of None
+    means delete src's entry. Prog_op is None if prog_cache doesn't need to change.
+    """
+
+    def is_chflag_err(e):
+        if isinstance(e, subprocess.CalledProcessError):
+            return all([b in e.stderr for b in (b'chflags: ', b': Invalid argument')])
+        # copyfile has no errno of its own for chflags, so EINVAL only counts if the file itself made it over.
+        # Otherwise it's something else, like a filename the dst filesystem won't take
+        return e.errno == errno.EINVAL and os.path.lexists(dst)
+
+    def copy():
+        """Copies src to dst, raising FileExistsError if dst is already there."""
+        try:
+            if args.use_bin_cp:
+                # cp -n skips an existing dst without an error, so check for one first
+                if os.path.lexists(dst):
+                    raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+                bin_cp(src, dst)
+            else:
+                cp(src, dst)
+        except FileExistsError:
+            raise
+        except (OSError, subprocess.CalledProcessError) as e:
+            # Test to see if chflags: invalid argument is what caused this error
+            if not args.ignore_chflags_err or not is_chflag_err(e):
+                raise
+
+    try:
+        # Check and see if src has errored before, and if it's gone over attempts limit.
+        # Also, do a byte-by-byte compare on the file to see if it was copied correctly.
+        if prev_err is not None:
+            if prev_err['attempts'] >= ATTEMPTS:
+                print(f"File {src} has reached its attempt limit. "
+                      f"Try manually copying this file, or investigate what's going wrong.")
+                return src, None, None
+            elif cmp(src, dst, False):
+                # If we reach this, the file has actually been copied over just fine.
+                # Proceed to make sure that metadata is copied and remove from prog_cache
+                print(f'File {dst} has been copied over despite its error.')
+                clone_attrs(src, dst, follow_symlinks=not os.path.islink(dst), limit=50)
+                return src, None, (src, None)
+
+        src_st = os.lstat(src)
+        # Symlinks are copied as symlinks, so unless dst turns out to already be there, it's whatever src is
+        dst_islink = stat.S_ISLNK(src_st.st_mode)
+        if stat.S_ISDIR(src_st.st_mode):
+            # Treat dirs specially - if a dir hasn't been created yet, it's empty, so no need to cp
+            os.makedirs(dst, exist_ok=True)
+        else:
+            try:
+                copy()
+            except FileExistsError:
+                # dst is only stat'd once the copy has found it's already there
+                dst_st = os.lstat(dst)
+                dst_islink = stat.S_ISLNK(dst_st.st_mode)
+
+                # rsync-style quick check: regular files whose sizes and mtimes already match are taken as copied,
+                # so don't copy or clone attrs for them. Like rsync's --checksum, -c turns this off, since it asks
+                # for contents to be compared regardless. Mtimes only need to be within --modify-window, for
+                # filesystems like FAT32 that can't store them exactly
+                if args.quick_check and not args.compare and \
+                        stat.S_ISREG(src_st.st_mode) and stat.S_ISREG(dst_st.st_mode) and \
+                        src_st.st_size == dst_st.st_size and \
+                        abs(src_st.st_mtime_ns - dst_st.st_mtime_ns) <= args.modify_window * 1_000_000_000:
+                    return src, None, ((src, None) if prev_err is not None else None)
+
+                if args.compare and (dst_islink or stat.S_ISREG(dst_st.st_mode)) and \
+                        not cmp(src, dst, shallow=args.shallow):
+                    print(f'File/dir {dst} failed comparison. Deleting it and trying again.')
+                    os.unlink(dst)
+                    copy()
+                    dst_islink = stat.S_ISLNK(src_st.st_mode)
+                # Otherwise, leave dst be like cp -n would
+
+        clone_attrs(src, dst, follow_symlinks=not dst_islink, limit=50)
+    except Exception as e:
+        print(f'Error on file\n\t {src}\n\t{e}')
+        if prev_err is None:
+            # Only strings are stored, since pickling the exception itself drags its traceback's frames along
+            return src, e, (src, {'src': src, 'dst': dst, 'attempts': 1, 'exc_type': type(e).__name__,
+                                  'exc_msg': str(e), 'traceback': traceback.format_exc()})
+        elif prev_err['attempts'] < ATTEMPTS:
+            prev_err['attempts'] += 1
+            return src, e, (src, prev_err)
+
+        return src, e, None
+
+    # Only files that had an entry need one removed
+    return src, None, ((src, None) if prev_err is not None else None)
+
+
+def load_prog_records():
+    """Reads every record in prog_cache into a dict of {src: record}, in a single pass."""
+    records = {}
+    for key in prog_cache.iterkeys():
+        record = prog_cache.get(key)
+        if record is not None:
+            records[key] = record
+    return records
+
+
+def flush_prog_ops(prog_ops):
+    """Applies prog_ops from _copy_one to prog_cache in a single transaction, then empties prog_ops."""
+    if not prog_ops:
+        return
+
+    with prog_cache.transact(retry=True):
+        for key, record in prog_ops:
+            if record is None:
+                prog_cache.delete(key)
+            else:
+                prog_cache.set(key, record)
+    prog_ops.clear()
+
+
+def imap_pool(func, pairs):
     """
-    Copies contents of src_ls to dst_ls.
-    Src_ls and dst_ls are expected to be the same length and in the same order.
-    This yields so that progress can be printed. If an exception is encountered during the copy,
-    it is added to a list of exceptions.
-    The exception list is formatted like this: [[src, dst, exception], [src2, dst2, exception2], etc...]
+    Calls func(src, dst) for each (src, dst) in pairs on up to args.concurrency worker threads, yielding each result
+    as soon as it's ready (so not necessarily in order).
+    Pairs may be any iterable, including a generator that's still walking the tree. It's only read far enough ahead
+    to keep MAX_IN_FLIGHT calls queued, so work starts right away and memory stays bounded.
     """
+    pairs = iter(pairs)
+    in_flight = set()
+    # Each call hands its future over as it finishes, so picking up the next result doesn't depend on how many
+    # calls are queued
+    finished = queue.Queue()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        try:
+            while True:
+                # Top the queue back up, then wait for a call to finish
+                for src, dst in itertools.islice(pairs, MAX_IN_FLIGHT - len(in_flight)):
+                    future = executor.submit(func, src, dst)
+                    in_flight.add(future)
+                    future.add_done_callback(finished.put)
+                if not in_flight:
+                    break
+                future = finished.get()
+                in_flight.discard(future)
+
+                yield future.result()
+        finally:
+            # If the caller stopped early (Ctrl-C, an exception, or closing this generator), don't let the executor
+            # run everything still queued on its way out. Nobody would collect those results, so their failures
+            # would never reach prog_cache. Only calls that already started are waited on.
+            for future in in_flight:
+                future.cancel()
 
-    def is_chflag_err():
-        return all([b in e.stderr for b in (b'chflags: ', b': Invalid argument')])
 
+def cp_ls(pairs, prev_errs=None):
+    """
+    Copies each (src, dst) in pairs, using imap_pool, so pairs can still be being walked.
+    This yields (count, errs) as each copy completes so that progress can be printed.
+    If an exception is encountered during a copy, its src is added to errs.
+    Changes to prog_cache are written every PROG_BATCH_SIZE files, each batch in one transaction.
+    Prev_errs is prog_cache's records from load_prog_records, if the caller already has them.
+    """
     errs = []
-    for idx, (src, dst) in enumerate(zip(src_ls, dst_ls), start=1):
-        prev_err = prog_cache.get(src)
+    prog_ops = []
+    # Most files have never failed, so load the few records there are once, rather than querying prog_cache per file
+    if prev_errs is None:
+        prev_errs = load_prog_records()
+
+    def copy_one(src, dst):
+        return _copy_one(src, dst, prev_errs.get(src))
+
+    try:
+        for idx, (src, err, prog_op) in enumerate(imap_pool(copy_one, pairs), start=1):
+            # Results are collected on this thread, so errs and prog_ops are only ever touched here
+            if err is not None:
+                errs.append(src)
+            if prog_op is not None:
+                prog_ops.append(prog_op)
+                if len(prog_ops) >= PROG_BATCH_SIZE:
+                    flush_prog_ops(prog_ops)
+            yield idx, errs
+    finally:
+        flush_prog_ops(prog_ops)
+
+
+def iter_tree(src_root, dst_root, exclusions, verbose=False):
+    """
+    Walks src_root and yields ('dir' or 'file', src_path, dst_path) for everything in it as soon as it's found,
+    where dst_path is where src_path belongs under dst_root. A dir is always yielded before anything inside it.
+    Symlinks, including those pointing at directories, are yielded as files and never followed.
+    If dst_root is inside src_root, it's skipped, so the walk never descends into what's being copied.
+    """
+    if exclude_path(src_root, exclusions):
+        return
 
+    def is_dst_root(entry):
+        """Readdir already gave us entry's inode, so only a dir that could be dst_root gets stat'd."""
         try:
-            # Check and see if src has errored before, and if it's gone over attempts limit.
-            # Also, do a byte-by-byte compare on the file to see if it was copied correctly.
-            if prev_err is not None:
-                if prev_err['attempts'] >= ATTEMPTS:
-                    print(f"File {src} has reached its attempt limit. "
-                          f"Try manually copying this file, or investigate what's going wrong.")
-                    continue
-                elif cmp(src, dst, False):
-                    # If we reach this, the file has actually been copied over just fine.
-                    # Proceed to make sure that metadata is copied and remove from prog_cache
-                    print(f'File {dst} has been copied over despite its error.')
-                    clone_attrs(src, dst, follow_symlinks=not os.path.islink(dst), limit=50)
-                    prog_cache.delete(src)
+            return entry.inode() == dst_root_st.st_ino and \
+                os.path.samestat(entry.stat(follow_symlinks=False), dst_root_st)
+        except OSError:
+            return False
+
+    try:
+        dst_root_st = os.stat(dst_root)
+    except OSError:
+        dst_root_st = None
+
+    # Walk breadth-first with scandir, so dirs and files are told apart by the d_type readdir already returned,
+    # rather than a stat per entry. Excluded dirs are never pushed, so nothing beneath them is listed.
+    # Each dst dir is queued as a prefix that already ends in a separator, so building a dst path is a single concat
+    pending = deque([(src_root, dst_root if dst_root.endswith('/') else dst_root + '/')])
+    # Bound to locals, since they're looked up for every entry in the tree
+    _exclude_path = exclude_path
+    _push = pending.append
+    while pending:
+        src_dir, dst_prefix = pending.popleft()
+        try:
+            it = os.scandir(src_dir)
+        except OSError as e:
+            print(f'Unable to list {src_dir}. Skipping\n\t{e}')
+            continue
+
+        with it:
+            while True:
+                # Reading the listing can fail partway through too, e.g. when a network or USB source drops out
+                try:
+                    entry = next(it)
+                except StopIteration:
+                    break
+                except OSError as e:
+                    print(f'Unable to finish listing {src_dir}. Skipping the rest of it\n\t{e}')
+                    break
+
+                # scandir has already joined src_dir and the name in C, the same way os.path.join would
+                src = entry.path
+                if _exclude_path(src, exclusions):
+                    if verbose:
+                        print(f'Excluding {src}')
                     continue
 
-            if (os.path.isfile(dst) or os.path.islink(dst)) and \
-                    (args.compare and not cmp(src, dst, shallow=args.shallow)):
-                print(f'File/dir {dst} failed comparison. Deleting it and trying again.')
-                os.unlink(dst)
-            if not os.path.exists(dst) and not os.path.islink(dst):
-                if os.path.isdir(src):
-                    # Treat dirs specially - if a dir hasn't been created yet, it's empty, so no need to cp
-                    os.makedirs(dst, exist_ok=True)
+                dst = dst_prefix + entry.name
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    is_dir = False  # Without a d_type, is_dir has to stat the entry, which fails if it's gone since
+                if is_dir:
+                    if dst_root_st is not None and is_dst_root(entry):
+                        if verbose:
+                            print(f'Skipping {src}, since it is the destination')
+                        continue
+                    _push((src, dst + '/'))
+                    yield 'dir', src, dst
                 else:
-                    os.makedirs(os.path.dirname(dst), exist_ok=True)
-                    try:
-                        cp(src, dst)
-                    except subprocess.CalledProcessError as e:
-                        # Test to see if chflags: invalid argument is what caused this error
-                        if not args.ignore_chflags_err or not is_chflag_err():
-                            raise
-
-            clone_attrs(src, dst, follow_symlinks=not os.path.islink(dst), limit=50)
-            prog_cache.delete(src)
-        except Exception as e:
-            print(f'Error on file\n\t {src}\n\t{e}')
-            if prev_err is None:
-                prog_cache.set(src, {'src': src, 'dst': dst, 'attempts': 1,
-                                     'exception': e, 'traceback': traceback.format_exc()})
-            elif prev_err['attempts'] < ATTEMPTS:
-                prev_err['attempts'] += 1
-                prog_cache.set(src, prev_err)
+                    yield 'file', src, dst
 
-            errs.append(src)
 
-        finally:
-            yield idx, errs
+def split_tree(tree, dir_pairs):
+    """
+    Takes the tuples from iter_tree, appending each dir's (src, dst) to dir_pairs as it goes.
+    Yields the file pairs, so files can be copied while the tree is still being walked, without holding onto them.
+    Each dst dir is created as soon as it's found. Since a dir always comes before anything in it, a file's parent
+    already exists by the time it's yielded, so copying it never has to create (or even check) its parents.
+    """
+    for kind, src, dst in tree:
+        if kind == 'dir':
+            try:
+                os.mkdir(dst)
+            except OSError:
+                pass  # Most likely it already exists. Anything else gets retried and recorded by the dir pass
+            dir_pairs.append((src, dst))
+        else:
+            yield src, dst
 
 
-def ls_dir(dir_path, exclusions, verbose=False):
-    """Returns a list of all directories, and files in a directory (recursively)."""
+def spool_pairs(pairs, spool):
+    """
+    Writes each (src, dst) in pairs to spool, a binary file, as it passes through. read_spool plays them back later,
+    so a pass can revisit exactly what was walked without walking it again or holding every pair in memory.
+    """
+    for pair in pairs:
+        pickle.dump(pair, spool, pickle.HIGHEST_PROTOCOL)
+        yield pair
 
-    def check_exclusions(root, ls, res_ls):
-        """Checks all elements in ls for exclusions. If things aren't excluded, they're appended to res_ls."""
 
-        for cur in ls:
-            p = os.path.join(root, cur)
-            if exclude_path(p, exclusions):
-                if verbose:
-                    print(f'Excluding {p}')
-                continue
-            else:
-                res_ls.append(p)
+def read_spool(spool):
+    """Yields the (src, dst) pairs spool_pairs wrote to spool, from the start."""
+    spool.seek(0)
+    while True:
+        try:
+            yield pickle.load(spool)
+        except EOFError:
+            return
 
-    dirs_result = []
-    files_result = []
 
-    # Append paths to all files and dirs to results
-    for root, dirs, files in os.walk(dir_path):
-        if exclude_path(root, exclusions):
-            continue
+def compile_exclusions(patterns):
+    """
+    Takes a list of exclusion wildcard patterns and compiles them for exclude_path.
+    Patterns without wildcards can only ever match that exact path, and ones like */name only match paths whose last
+    component is name, so both are put in sets for a hash lookup. The rest are fused into a single compiled regex,
+    so each path needs at most one match call no matter how many patterns there are.
+    Returns (paths, names, regex), where regex is None if every pattern was a literal.
+    """
 
-        # Check dirs for exclusions
-        check_exclusions(root, dirs, dirs_result)
+    def has_wildcard(pat):
+        return any(c in pat for c in '*?[')
 
-        # Check files for exclusions
-        check_exclusions(root, files, files_result)
+    paths, names, wildcards = set(), set(), []
+    # Repeated patterns would each become another alternative for the regex to try, so drop them up front
+    for pat in dict.fromkeys(patterns):
+        if not has_wildcard(pat):
+            paths.add(pat)
+        elif pat.startswith('*/') and '/' not in pat[2:] and not has_wildcard(pat[2:]):
+            names.add(pat[2:])
+        else:
+            wildcards.append(pat)
 
-    return dirs_result, files_result
+    regex = re.compile('|'.join(f'(?:{fnmatch.translate(pat)})' for pat in wildcards)) if wildcards else None
+    return paths, names, regex
 
 
 def exclude_path(path, exclusions):
     """
-    Takes a list of exclusion wildcard patterns and returns True if a path matches one.
+    Takes exclusions from compile_exclusions and returns True if a path matches one of its patterns.
     So, if this returns True, the path should be excluded.
     """
-    for pat in exclusions:
-        if fnmatch.fnmatchcase(path, pat):
-            return True
-    return False
+    paths, names, regex = exclusions
+    _, sep, name = path.rpartition('/')
+    if path in paths or (sep and name in names):
+        return True
+    return regex is not None and regex.match(path) is not None
+
+
+def meta_xattrs(path):
+    """Returns the names of path's xattrs that check_meta restores. Others, like com.apple.quarantine, are left alone."""
+    return [name for name in xattr.listxattr(path) if name in META_XATTRS or name.startswith(META_XATTR_PREFIX)]
 
 
-def change_parent(old, new, paths):
+def fast_meta_match(src, dst):
     """
-    Changes paths' parent from old to new. If paths is a list, will change all paths in
-    that list to the new parent, and return a new list.
+    Returns True if every one of src's metadata xattrs is on dst with the same raw bytes.
+    Metadata xattrs that only dst has are ignored, since check_meta never removes them.
     """
-    if isinstance(paths, str):
-        return os.path.join(new, paths[len(old):])
-    else:
-        result = []
-        for path in paths:
-            stripped_path = path[len(old):]
-            stripped_path = stripped_path if not stripped_path.startswith('/') else stripped_path[1:]
-            result.append(os.path.join(new, stripped_path))
-        return result
+    try:
+        names = meta_xattrs(src)
+        if not set(names) <= set(meta_xattrs(dst)):
+            return False
+        return all(xattr.getxattr(src, name) == xattr.getxattr(dst, name) for name in names)
+    except OSError:
+        return False
 
 
 def check_meta(src, dst):
-    """Checks src's metadata against dst's."""
-
-    def clean_meta_dict(meta):
-        """Takes a meta dict from osxmetadata.asdict and removes the keys starting with _."""
-        result = {}
-        for key, value in meta.asdict(True, True).items():
-            if not key.startswith("_"):
-                # skip private keys like _version and _filepath
-                result[key] = value
-
-        return result
-
-    src_meta = OSXMetaData(src)
-    src_meta_dict = clean_meta_dict(src_meta)
-    dst_meta = OSXMetaData(dst)
-    dst_meta_dict = clean_meta_dict(dst_meta)
-
-    if src_meta_dict != dst_meta_dict:
-        dst_meta._restore_attributes(src_meta.asdict(all_=True, encode=True), all_=True)
-        # Need to specifically set the following. They don't seem to get set with restore_attributes.
-        dst_meta.finderinfo.set_finderinfo_stationarypad(src_meta.stationarypad)
-        dst_meta.tags = src_meta.tags
-
-
-def check_meta_ls(old, new):
-    """Checks metadata of old against new. If it finds a difference, the old's metadata is copied to new."""
-    ls_len = len(old)
-    for idx, (src, dst) in enumerate(zip(old, new), start=1):
-        # We can skip meta check for symlinks since the files they point to will be checked
-        if not paths_are(os.path.islink, src, dst, cmp_func=any):
-            try:
-                check_meta(src, dst)
-            except PermissionError:
-                print(f'Permission error on {dst}. Skipping')
-            except Exception as e:
-                print(f'Error restoring meta to {dst}.\nError is {e}')
-        print(f'Restored {idx}/{ls_len}...', end='\r')
-    print()
-
-
-def copy_with_progress(old, new):
-    """Convenience function for copying files/dirs while displaying progress."""
-    ls_len = len(old)
-    if not ls_len:
+    """
+    Checks src's metadata against dst's. If they differ, each of src's metadata xattrs is copied over to dst
+    as raw bytes. Raises the first error encountered, but only after trying every xattr.
+    """
+    if fast_meta_match(src, dst):
+        return
+
+    first_err = None
+    for name in meta_xattrs(src):
+        try:
+            xattr.setxattr(dst, name, xattr.getxattr(src, name))
+        except OSError as e:
+            first_err = first_err or e
+    if first_err is not None:
+        raise first_err
+
+
+def _check_meta_one(src, dst):
+    """Runs check_meta on src and dst, printing (rather than raising) any errors. Safe to call from worker threads."""
+    # We can skip meta check for symlinks since the files they point to will be checked
+    if not (os.path.islink(src) or os.path.islink(dst)):
+        try:
+            check_meta(src, dst)
+        except PermissionError:
+            print(f'Permission error on {dst}. Skipping')
+        except Exception as e:
+            print(f'Error restoring meta to {dst}.\nError is {e}')
+
+
+def progress_redrawer():
+    """
+    Returns a function that says whether a progress line is due to be redrawn, which is at most once every
+    PROGRESS_INTERVAL seconds, and never if stdout isn't a terminal (where redraws would just pile up in a log).
+    Callers should still print their final count when they're done.
+    """
+    if not sys.stdout.isatty():
+        return lambda: False
+
+    last_draw = 0.0
+
+    def redraw():
+        nonlocal last_draw
+        now = time.monotonic()
+        if now - last_draw < PROGRESS_INTERVAL:
+            return False
+        last_draw = now
+        return True
+
+    return redraw
+
+
+def check_meta_ls(pairs):
+    """
+    Checks metadata of each src against its dst in (src, dst) pairs, using imap_pool.
+    If it finds a difference, the src's metadata is copied to dst.
+    """
+    idx = 0
+    redraw = progress_redrawer()
+    for idx, _ in enumerate(imap_pool(_check_meta_one, pairs), start=1):
+        if redraw():
+            print(f'Restored {idx}...', end='\r', flush=True)
+    print(f'Restored {idx}...')
+
+
+def copy_with_progress(pairs, total=None, prev_errs=None):
+    """
+    Convenience function for copying (src, dst) pairs while displaying progress.
+    Leave total as None if it isn't known yet, e.g. while pairs is still walking the tree.
+    Prev_errs is passed on to cp_ls.
+    """
+    if total == 0:
         return []
     cp_errs = []
+    c = 0
+    out_of = f'/{total}' if total is not None else ''
     start = time.time()
+    redraw = progress_redrawer()
 
-    for c, errs in cp_ls(old, new):
+    for c, errs in cp_ls(pairs, prev_errs):
         cp_errs = errs
-        print(f'Copied {c}/{ls_len}...{SPACE}Errors: {len(cp_errs)}', end='\r', flush=True)
-    print(f'Copied {ls_len}/{ls_len}...{SPACE}Time elapsed: {round(time.time() - start, 2)}')
+        if redraw():
+            print(f'Copied {c}{out_of}...{SPACE}Errors: {len(cp_errs)}', end='\r', flush=True)
+    print(f'Copied {c}{out_of}...{SPACE}Time elapsed: {round(time.time() - start, 2)}')
     return cp_errs
 
 
@@ -280,8 +677,13 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--compare', help='compare file contents if file exists on dst', action='store_true')
     parser.add_argument('-s', '--shallow',
                         help='when comparing, perform shallow comparison instead of byte-by-byte', action='store_true')
+    parser.add_argument('--no-quick-check', dest='quick_check',
+                        help="don't skip files on dst that already match src's size and modification time",
+                        action='store_false')
+    parser.add_argument('--modify-window', help='seconds two modification times can differ by and still match '
+                                                'when quick checking (use 2 for FAT32)', type=int, default=0)
     parser.add_argument('--no-cache', help='disable persistent failed file database '
-                                           '(a temp one will still be created)', action='store_true')
+                                           '(failures are only tracked in memory)', action='store_true')
     parser.add_argument('--cache-dir', help='custom dir for failed file database')
     parser.add_argument('-a', '--attempts', help='number of attempts before giving up on a file',
                         type=int, default=5)
@@ -289,7 +691,15 @@ if __name__ == '__main__':
                         nargs='+', default=[])
     parser.add_argument('--ignore-chflags-err',
                         help="don't count 'chflags: invalid argument' as an error", action='store_true')
+    parser.add_argument('--use-bin-cp', help='copy files by running /bin/cp -Rpn instead of copying in-process',
+                        action='store_true')
+    parser.add_argument('-j', '--concurrency', help='number of files to copy at once',
+                        type=int, default=8)
     args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    if args.modify_window < 0:
+        parser.error("--modify-window can't be negative")
 
     SRC = args.src
     DST = args.dst
@@ -299,58 +709,54 @@ if __name__ == '__main__':
     # The progress file
     print('Loading progress file...')
     if not args.no_cache:
-        prog_cache = Cache(args.cache_dir or os.path.join(SRC, PROG_FILE_NAME))
+        prog_cache = Cache(args.cache_dir or os.path.join(SRC, PROG_FILE_NAME), eviction_policy='none')
     else:
-        prog_cache = Cache(None)
+        prog_cache = InMemoryCache()
 
     if args.reset:
         print('Resetting failed file database...')
         prog_cache.clear()
 
     print(f'Copying folder {SRC} to {DST}')
-
-    print(f'Getting list of directories and files in {SRC}...')
-    old_dir_list, old_file_list = ls_dir(SRC, args.exclude, verbose=True)
-
-    # Get new lists with the parents changed from SRC to DST
-    new_dir_list, new_file_list = change_parent(SRC, DST, old_dir_list), change_parent(SRC, DST, old_file_list)
-
-    # Copy files to new destination
-    print(f'COPYING {len(old_file_list)} FILES...')
-    file_cp_errs = copy_with_progress(old_file_list, new_file_list)
+    os.makedirs(DST, exist_ok=True)
+
+    # Copy files to new destination while SRC is still being walked. Dirs are collected along the way for later,
+    # and file pairs are spooled to disk for the metadata pass
+    print(f'COPYING FILES IN {SRC}...')
+    exclusions = compile_exclusions(args.exclude)
+    dir_pairs = []
+    spool = tempfile.TemporaryFile()
+    file_cp_errs = copy_with_progress(spool_pairs(split_tree(iter_tree(SRC, DST, exclusions, verbose=True),
+                                                             dir_pairs), spool))
     print(f'All files copied. Errors encountered: {len(file_cp_errs)}')
 
     # Copy dirs to new destination (only empty dirs should need to be created)
-    print(f'COPYING {len(old_dir_list)} DIRECTORIES...')
-    dir_cp_errs = copy_with_progress(old_dir_list, new_dir_list)
+    print(f'COPYING {len(dir_pairs)} DIRECTORIES...')
+    dir_cp_errs = copy_with_progress(dir_pairs, len(dir_pairs))
     print(f'All directories copied. Errors encountered: {len(dir_cp_errs)}', flush=True)
 
     # Retry until all files and dirs have been copied or until files reach attempt limit
     print(f'Retrying files and directories with errors up to {ATTEMPTS} attempts...')
 
-    c = 0
-    while c < ATTEMPTS or True:
+    # Every failed retry bumps a file's attempts, so ATTEMPTS passes is enough for every file to either succeed or
+    # hit its limit. The bound just guarantees this ends.
+    for _ in range(ATTEMPTS):
         # Retry files that are under the attempt limit
-        combined_errs = [prog_cache.get(x) for x in prog_cache.iterkeys()]
-
-        src_retries = [d['src'] for d in combined_errs if d['attempts'] < ATTEMPTS]
-        dst_retries = [d['dst'] for d in combined_errs if d['attempts'] < ATTEMPTS]
+        records = load_prog_records()
+        retries = [(err['src'], err['dst']) for err in records.values() if err['attempts'] < ATTEMPTS]
+        # prog_cache hands records back in no useful order, so group them by dst dir to keep each dir's lookups warm
+        retries.sort(key=lambda pair: (os.path.dirname(pair[1]), pair[0]))
 
-        print(f'{len(src_retries)} files/directories to be retried.')
-        if not copy_with_progress(src_retries, dst_retries):
-            print('All files/directories have been copied or have reached their error limit.')
+        print(f'{len(retries)} files/directories to be retried.')
+        if not copy_with_progress(retries, len(retries), prev_errs=records):
             break
-
-    # Filter out files that didn't make it from old and new file/dir lists before metadata copy
-    old_list = old_file_list + old_dir_list
-    new_list = new_file_list + new_dir_list
-    for key in prog_cache.iterkeys():
-        err = prog_cache.get(key)
-        old_list.remove(err['src'])
-        new_list.remove(err['dst'])
-
-    # Restore metadata to files/dirs
-    print(f'RESTORING METADATA TO {len(old_list)} FILES/DIRECTORIES...')
-    check_meta_ls(old_list, new_list)
+    print('All files/directories have been copied or have reached their error limit.')
+
+    # Restore metadata to the files/dirs that were walked, skipping the ones that didn't make it.
+    # prog_cache is keyed by src, so its keys are all we need
+    failed_srcs = set(prog_cache.iterkeys())
+    print('RESTORING METADATA TO FILES/DIRECTORIES...')
+    with spool:
+        check_meta_ls(pair for pair in itertools.chain(read_spool(spool), dir_pairs) if pair[0] not in failed_srcs)
 
     print('Done!')